@@ -1,6 +1,9 @@
 import streamlit as st
+import importlib.util
 import re
-import tiktoken
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 # --- Setup Page Config ---
 st.set_page_config(
@@ -9,114 +12,282 @@ st.set_page_config(
     page_icon="🧹"
 )
 
+# --- Regex Patterns ---
+# Compiled once at import so each cleaning pass calls Pattern.sub directly
+# instead of going through the re module's compile cache on every call.
+
+# XML/HTML tags
+# The body excludes '<' as well as '>', so a '<' that never closes fails at the
+# next '<' instead of scanning (and backtracking) to the end of the text.
+_RE_TAG = re.compile(r'<[^<>]+>')
+
+# Markdown formatting
+# Line-level patterns are matched against one line at a time, so \s never spans a newline.
+# First characters (after indentation) that can start line-level markup
+_LINE_MARKERS = frozenset('#>*-+_[0123456789')
+# Line prefixes: headings, blockquotes, task/unordered/ordered list markers.
+# Repeated so stacked prefixes like "> - item" are stripped in one pass.
+_RE_LINE_PREFIX = re.compile(
+    r'(?:\s*(?:#{1,6}\s*|>\s?|[\*\-\+]\s*\[[xX ]\]\s*|[\*\-\+](?:\s+|$)|\d+\.\s+))+'
+)
+_RE_LINK_DEFINITION = re.compile(r'\s*\[[^\]]+\]:\s*\S')
+_RE_HORIZONTAL_RULE = re.compile(r'[\-\*_]{3,}\s*')
+# Inline patterns are matched against the whole text so spans can wrap across lines.
+# Every repeat stops at the next opening delimiter as well as the closing one, so a
+# failed match gives up at the next '[' or '(' instead of scanning to the end of the
+# text. That keeps each pass linear even on adversarial input like "[[[[" or "[a](((".
+# Link text may hold one level of nested brackets, so badges like [![alt](img)](url) match as one link.
+_LINK_TEXT = r'(?!\])[^\[\]]*(?:\[[^\[\]]*\][^\[\]]*)*'
+# Link targets allow one level of nested parentheses, e.g. (https://en.wikipedia.org/wiki/Foo_(bar))
+_LINK_TARGET = r'\([^()]*(?:\([^()]*\)[^()]*)*\)'
+# One character of an emphasis body: a non-marker character or a whole `code` span.
+# Bodies take '`' only as part of a complete span, so a snake_case underscore or a
+# stray '*' can't pair up across a code span and split its backticks.
+_STAR_CHAR = r'(?:[^*`]|`[^`]+`)'
+_UNDERSCORE_CHAR = r'(?:[^_`]|`[^`]+`)'
+_TILDE_CHAR = r'(?:[^~`]|`[^`]+`)'
+# Inline markup is matched by two alternations, each scanned once. Every alternative
+# has at most one capture group holding the text to keep; footnotes have none and are dropped.
+# Bracketed markup goes first, so an emphasis marker in prose can't pair with a '_' or '*'
+# inside a later link URL and split the link across slices.
+_RE_BRACKETED = re.compile(
+    r'!\[([^\[\]]*)\]' + _LINK_TARGET +                   # image: ![alt](url)
+    r'|\[(' + _LINK_TEXT + r')\]' + _LINK_TARGET +        # link: [text](url)
+    r'|\[(' + _LINK_TEXT + r')\]\[[^\[\]]*\]'             # reference link: [text][ref]
+    r'|\[\^[^\[\]]+\]'                                    # footnote: [^1]
+)
+_RE_INLINE = re.compile(
+    r'`([^`]+)`'                                          # inline code: `code`
+    r'|\*\*\*(' + _STAR_CHAR + r'+)\*\*\*'                    # bold italic: ***text***
+    r'|___(' + _UNDERSCORE_CHAR + r'+)___'                    # bold italic: ___text___
+    r'|\*\*(' + _STAR_CHAR + r'+)\*\*'                        # bold: **text**
+    r'|__(' + _UNDERSCORE_CHAR + r'+)__'                      # bold: __text__
+    # Italic bodies may hold a bold run: *ital **bold** ital*
+    r'|(?<!\*)\*((?:' + _STAR_CHAR + r'|\*\*' + _STAR_CHAR + r'+\*\*)+)\*(?!\*)'
+    r'|(?<!_)_((?:' + _UNDERSCORE_CHAR + r'|__' + _UNDERSCORE_CHAR + r'+__)+)_(?!_)'
+    r'|~~(' + _TILDE_CHAR + r'+)~~'                           # strikethrough: ~~text~~
+)
+# Characters that must be present for _RE_INLINE to match anything
+_INLINE_MARKERS = ('`', '*', '_', '~~')
+
+# Whitespace
+_RE_EXTRA_NEWLINES = re.compile(r'\n{3,}')
+
 # --- Processing Functions ---
 
 def clean_xml_tags(text):
     """Removes HTML/XML-like tags (e.g., <CodeGroup>, <Tip>) but keeps content inside."""
-    # Remove self-closing tags like <img ... />
-    text = re.sub(r'<[^>]+/>', '', text)
-    # Remove opening and closing tags but keep content between them
-    text = re.sub(r'<[^>]+>', '', text)
+    if '<' not in text:
+        return text
+    # Remove opening, closing and self-closing tags (<img ... />) but keep content between them
+    text = _RE_TAG.sub('', text)
     return text
 
 def clean_code_block_markers(text):
     """Removes triple backtick markers and language hints, but KEEPS the code inside."""
-    # Remove opening ``` with optional language identifier (e.g., ```python, ```typescript  theme={null})
-    text = re.sub(r'^```[^\n]*\n?', '', text, flags=re.MULTILINE)
-    # Remove closing ```
-    text = re.sub(r'^```\s*$', '', text, flags=re.MULTILINE)
-    return text
+    if '```' not in text:
+        return text
+    # Drop every line that starts with ``` (e.g., ```python, ```typescript  theme={null}, or a closing ```).
+    # Scans with str.find from one fence to the next instead of running a regex over every line.
+    parts = []
+    kept_from = 0
+    search_from = 0
+    while True:
+        start = text.find('```', search_from)
+        if start == -1:
+            break
+        end = text.find('\n', start)
+        end = len(text) if end == -1 else end + 1
+        if start > 0 and text[start - 1] != '\n':
+            # Backticks in the middle of a line are not a fence; resume at the next line
+            search_from = end
+            continue
+        parts.append(text[kept_from:start])
+        kept_from = search_from = end
+    parts.append(text[kept_from:])
+    return ''.join(parts)
+
+def _strip_inline_markup(text, pattern):
+    """Replaces each span matched by pattern with its cleaned inner text, building the output in one join."""
+    parts = []
+    kept_from = 0
+    for match in pattern.finditer(text):
+        parts.append(text[kept_from:match.start()])
+        if match.lastindex:
+            # Clean nested markup too, e.g. [![alt](img)](url) or ***`code`***
+            parts.append(_strip_inline_markup(match.group(match.lastindex), pattern))
+        kept_from = match.end()
+    if not parts:
+        return text
+    parts.append(text[kept_from:])
+    return ''.join(parts)
+
+def _clean_markdown_lines(text):
+    """Removes line-level markdown (prefixes, link definitions, horizontal rules) in one pass over the lines."""
+    lines = []
+    for line in text.split('\n'):
+        stripped = line.lstrip()
+        if stripped and stripped[0] in _LINE_MARKERS:
+            # Remove heading, blockquote and list markers (# Header, > quote, - item, 1. item, - [ ] task -> text)
+            prefix = _RE_LINE_PREFIX.match(line)
+            if prefix:
+                line = line[prefix.end():]
+            # Remove horizontal rules (---, ***, ___) and link definitions ([ref]: url)
+            if _RE_HORIZONTAL_RULE.fullmatch(line) or _RE_LINK_DEFINITION.match(line):
+                line = ''
+        lines.append(line)
+    return '\n'.join(lines)
+
+def _strip_html_comments(text):
+    """Removes <!-- ... --> comments, stopping at the first comment that never closes."""
+    parts = []
+    kept_from = 0
+    while True:
+        start = text.find('<!--', kept_from)
+        if start == -1:
+            break
+        end = text.find('-->', start + 4)
+        if end == -1:
+            # No later comment can close either
+            break
+        parts.append(text[kept_from:start])
+        kept_from = end + 3
+    parts.append(text[kept_from:])
+    return ''.join(parts)
 
 def clean_markdown_formatting(text):
     """Removes markdown formatting symbols but keeps the text content."""
-    # Remove headings markers (# Header -> Header)
-    text = re.sub(r'^\s*#{1,6}\s*', '', text, flags=re.MULTILINE)
-    
-    # Remove bold (**text** -> text, __text__ -> text)
-    text = re.sub(r'\*\*([^*]+)\*\*', r'\1', text)
-    text = re.sub(r'__([^_]+)__', r'\1', text)
-    
-    # Remove italic (*text* -> text, _text_ -> text) - be careful not to match list markers
-    text = re.sub(r'(?<!\*)\*([^*]+)\*(?!\*)', r'\1', text)
-    text = re.sub(r'(?<!_)_([^_]+)_(?!_)', r'\1', text)
-    
-    # Remove strikethrough (~~text~~ -> text)
-    text = re.sub(r'~~([^~]+)~~', r'\1', text)
+    # Remove line-level markup: headings, blockquotes, lists, link definitions, horizontal rules
+    text = _clean_markdown_lines(text)
     
-    # Remove blockquote markers (> text -> text)
-    text = re.sub(r'^\s*>\s?', '', text, flags=re.MULTILINE)
+    # Remove HTML comments before looking for markup inside them
+    if '<!--' in text:
+        text = _strip_html_comments(text)
     
-    # Remove links but keep link text ([text](url) -> text)
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    # Remove links and images but keep their text: ![alt](url), [text](url), [text][ref] -> text, [^1] -> nothing
+    if '[' in text:
+        text = _strip_inline_markup(text, _RE_BRACKETED)
     
-    # Remove reference-style links ([text][ref] -> text)
-    text = re.sub(r'\[([^\]]+)\]\[[^\]]*\]', r'\1', text)
-    
-    # Remove link definitions ([ref]: url)
-    text = re.sub(r'^\s*\[[^\]]+\]:\s*\S+.*$', '', text, flags=re.MULTILINE)
-    
-    # Remove images entirely (![alt](url) -> nothing, or keep alt text)
-    text = re.sub(r'!\[([^\]]*)\]\([^\)]+\)', r'\1', text)
-    
-    # Remove horizontal rules (---, ***, ___)
-    text = re.sub(r'^[\-\*_]{3,}\s*$', '', text, flags=re.MULTILINE)
-    
-    # Remove inline code backticks but keep content (`code` -> code)
-    text = re.sub(r'`([^`]+)`', r'\1', text)
-    
-    # Remove unordered list markers (* item, - item, + item -> item)
-    text = re.sub(r'^\s*[\*\-\+]\s+', '', text, flags=re.MULTILINE)
-    
-    # Remove ordered list markers (1. item -> item)
-    text = re.sub(r'^\s*\d+\.\s+', '', text, flags=re.MULTILINE)
-    
-    # Remove task list markers (- [ ] or - [x])
-    text = re.sub(r'^\s*[\*\-\+]\s*\[[xX ]\]\s*', '', text, flags=re.MULTILINE)
-    
-    # Remove HTML comments
-    text = re.sub(r'<!--[\s\S]*?-->', '', text)
-    
-    # Remove footnotes
-    text = re.sub(r'\[\^[^\]]+\]', '', text)
+    # Remove inline code and emphasis but keep their text:
+    # `code`, **text**, __text__, *text*, _text_, ~~text~~ -> text
+    if any(marker in text for marker in _INLINE_MARKERS):
+        text = _strip_inline_markup(text, _RE_INLINE)
     
     return text
 
 def normalize_whitespace(text):
     """Reduces multiple newlines to single/double newlines."""
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    if '\n\n\n' in text:
+        text = _RE_EXTRA_NEWLINES.sub('\n\n', text)
     return text.strip()
 
 # --- Token Counter ---
+# tiktoken is only imported when an exact count is requested, so startup
+# doesn't pay for loading the module and its BPE merge table.
+TIKTOKEN_AVAILABLE = importlib.util.find_spec("tiktoken") is not None
+
+def estimate_tokens(text):
+    """Fast token estimate (~4 characters per token) used for the live preview."""
+    return (len(text) + 3) // 4
+
 @st.cache_resource
 def get_tokenizer():
     """Cache the tokenizer for performance."""
+    import tiktoken
     return tiktoken.get_encoding("cl100k_base")
 
 def count_tokens(text):
     """Count tokens using tiktoken (GPT-4/Claude compatible)."""
     enc = get_tokenizer()
-    return len(enc.encode(text))
+    # Pasted text is never meant to contain special tokens like <|endoftext|>,
+    # so skip tiktoken's special-token check and encode it as ordinary text.
+    return len(enc.encode_ordinary(text))
 
-def process_text(text, settings):
-    """Master processing function based on settings dictionary."""
-    processed = text
+def count_tokens_batch(texts):
+    """Count tokens for several texts at once, encoding them in parallel threads."""
+    if len(texts) == 1:
+        return [count_tokens(texts[0])]
+    enc = get_tokenizer()
+    batch = enc.encode_ordinary_batch(list(texts), num_threads=len(texts))
+    return [len(ids) for ids in batch]
+
+@lru_cache(maxsize=8)
+def get_pipeline(strip_code_blocks, strip_xml, strip_markdown):
+    """Build the list of cleaning steps once per settings combination."""
+    steps = []
     
     # 1. Strip Code Block Markers (keeps code content)
-    if settings.get('strip_code_blocks'):
-        processed = clean_code_block_markers(processed)
+    if strip_code_blocks:
+        steps.append(clean_code_block_markers)
         
     # 2. Strip XML/HTML Tags (keeps content inside)
-    if settings.get('strip_xml'):
-        processed = clean_xml_tags(processed)
+    if strip_xml:
+        steps.append(clean_xml_tags)
         
     # 3. Strip Standard Markdown Formatting (keeps text content)
-    if settings.get('strip_markdown'):
-        processed = clean_markdown_formatting(processed)
+    if strip_markdown:
+        steps.append(clean_markdown_formatting)
         
     # 4. Normalize Whitespace
-    processed = normalize_whitespace(processed)
+    steps.append(normalize_whitespace)
+    
+    return tuple(steps)
+
+def process_text(text, settings):
+    """Master processing function based on settings dictionary."""
+    pipeline = get_pipeline(
+        bool(settings.get('strip_code_blocks')),
+        bool(settings.get('strip_xml')),
+        bool(settings.get('strip_markdown'))
+    )
+    for step in pipeline:
+        text = step(text)
+    return text
+
+# --- Cached Wrappers ---
+# Settings are passed as separate booleans so Streamlit can hash the arguments.
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def cached_process_text(text, strip_code_blocks, strip_xml, strip_markdown):
+    """Cache cleaned output per input text and settings combination."""
+    return process_text(text, {
+        'strip_code_blocks': strip_code_blocks,
+        'strip_xml': strip_xml,
+        'strip_markdown': strip_markdown
+    })
+
+TOKEN_CACHE_MAX_ENTRIES = 32
+
+@st.cache_resource
+def get_token_count_cache():
+    """Token counts keyed by text, shared across sessions, with the lock that guards them."""
+    return threading.Lock(), OrderedDict()
+
+def exact_token_counts(original, cleaned):
+    """Exact (original, cleaned) token counts, encoding only the texts not counted yet.
     
-    return processed
+    Each text is cached on its own and the least recently used entry is evicted first,
+    so an input that stays in use is not re-encoded when only its output changes.
+    When both texts are new, they go to tiktoken in a single batch call.
+    """
+    lock, cache = get_token_count_cache()
+    counts = {}
+    with lock:
+        for text in (original, cleaned):
+            if text in cache:
+                cache.move_to_end(text)
+                counts[text] = cache[text]
+    # dict.fromkeys drops the duplicate when nothing was stripped
+    missing = [text for text in dict.fromkeys((original, cleaned)) if text not in counts]
+    if missing:
+        # Encode outside the lock so other sessions aren't blocked on tiktoken
+        new_counts = dict(zip(missing, count_tokens_batch(missing)))
+        counts.update(new_counts)
+        with lock:
+            cache.update(new_counts)
+            while len(cache) > TOKEN_CACHE_MAX_ENTRIES:
+                cache.popitem(last=False)
+    return counts[original], counts[cleaned]
 
 # --- UI Layout ---
 
@@ -193,16 +364,40 @@ elif mode == "Custom":
 # Use session state to store output
 if 'output_text' not in st.session_state:
     st.session_state.output_text = None
+    st.session_state.input_text = None
+    st.session_state.processed_settings = None
     st.session_state.orig_tokens = 0
     st.session_state.new_tokens = 0
+    st.session_state.exact_tokens = None
+
+settings_key = (settings['strip_code_blocks'], settings['strip_xml'], settings['strip_markdown'])
 
-if process_button and input_text:
+def already_processed():
+    """Whether the current output was built from this input with these settings."""
+    return (
+        st.session_state.input_text == input_text
+        and st.session_state.processed_settings == settings_key
+    )
+
+if process_button and input_text and not already_processed():
     # Run the cleaner
-    st.session_state.output_text = process_text(input_text, settings)
-    st.session_state.orig_tokens = count_tokens(input_text)
-    st.session_state.new_tokens = count_tokens(st.session_state.output_text)
+    st.session_state.output_text = cached_process_text(input_text, *settings_key)
+    st.session_state.input_text = input_text
+    st.session_state.processed_settings = settings_key
+    st.session_state.orig_tokens = estimate_tokens(input_text)
+    st.session_state.new_tokens = estimate_tokens(st.session_state.output_text)
+    # Exact counts are for the previous output; recount on request
+    st.session_state.exact_tokens = None
 
-if st.session_state.output_text:
+@st.fragment
+def output_panel():
+    """Cleaned output and token stats. Runs as a fragment, so its buttons rerun only this panel."""
+    st.subheader("Cleaned Output")
+    
+    if not st.session_state.output_text:
+        st.info("Paste content and click **Process** to strip formatting.")
+        return
+    
     output_text = st.session_state.output_text
     orig_tokens = st.session_state.orig_tokens
     new_tokens = st.session_state.new_tokens
@@ -210,23 +405,35 @@ if st.session_state.output_text:
     tokens_saved = orig_tokens - new_tokens
     pct_savings = (tokens_saved / orig_tokens * 100) if orig_tokens > 0 else 0
     
-    with col2:
-        st.subheader("Cleaned Output")
-        
-        # Token stats in metrics
-        m1, m2, m3 = st.columns(3)
-        m1.metric("Original Tokens", f"{orig_tokens:,}")
-        m2.metric("Final Tokens", f"{new_tokens:,}")
-        m3.metric("Tokens Saved", f"{tokens_saved:,}", f"-{pct_savings:.1f}%")
-        
-        # Output Area
-        st.text_area("Result", value=output_text, height=400, label_visibility="collapsed")
-        
-        # Copy button
-        st.button("📋 Copy to Clipboard", use_container_width=True, 
-                  on_click=lambda: st.write("<script>navigator.clipboard.writeText(`" + output_text.replace('`', '\\`') + "`)</script>", unsafe_allow_html=True))
+    # Token stats in metrics (estimated)
+    m1, m2, m3 = st.columns(3)
+    m1.metric("Original Tokens (est.)", f"~{orig_tokens:,}")
+    m2.metric("Final Tokens (est.)", f"~{new_tokens:,}")
+    m3.metric("Tokens Saved (est.)", f"~{tokens_saved:,}", f"-{pct_savings:.1f}%")
+    
+    # Exact token stats via tiktoken, only when asked for
+    with st.expander("Exact token count"):
+        if not TIKTOKEN_AVAILABLE:
+            st.caption("Install `tiktoken` to get exact token counts.")
+        elif st.session_state.exact_tokens is None:
+            if st.button("🔢 Count exact tokens", use_container_width=True):
+                st.session_state.exact_tokens = exact_token_counts(st.session_state.input_text, output_text)
         
-else:
-    with col2:
-        st.subheader("Cleaned Output")
-        st.info("Paste content and click **Process** to strip formatting.")
+        if st.session_state.exact_tokens is not None:
+            exact_orig, exact_new = st.session_state.exact_tokens
+            exact_saved = exact_orig - exact_new
+            exact_pct = (exact_saved / exact_orig * 100) if exact_orig > 0 else 0
+            e1, e2, e3 = st.columns(3)
+            e1.metric("Original Tokens", f"{exact_orig:,}")
+            e2.metric("Final Tokens", f"{exact_new:,}")
+            e3.metric("Tokens Saved", f"{exact_saved:,}", f"-{exact_pct:.1f}%")
+    
+    # Output Area
+    st.text_area("Result", value=output_text, height=400, label_visibility="collapsed")
+    
+    # Copy button
+    st.button("📋 Copy to Clipboard", use_container_width=True, 
+              on_click=lambda: st.write("<script>navigator.clipboard.writeText(`" + output_text.replace('`', '\\`') + "`)</script>", unsafe_allow_html=True))
+
+with col2:
+    output_panel()